@@ -4,19 +4,26 @@ FastAPI 后端入口
 运行示例：
     cd backend
     python -m uvicorn main:app --host 0.0.0.0 --port 8000
+多进程部署（每个 worker 在 lifespan 中各自加载模型）：
+    python -m uvicorn main:app --host 0.0.0.0 --port 8000 --workers $WEB_CONCURRENCY
 """
 
 import os
+import re
 import asyncio
-import json
+import orjson
+import sqlite3
+import threading
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from typing import Optional
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel
-from model_server import ContractClassifierServer
+from fastapi.responses import ORJSONResponse, FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from model_server import ContractClassifierServer, ModelNotReadyError, PredictBatcher
 
 # ==========================
 # 模型配置（请按实际路径修改）
@@ -24,37 +31,104 @@ from model_server import ContractClassifierServer
 DEFAULT_BASE = "/home/huangtenghui/LLMAudit/model/llama-3.2-1B"
 DEFAULT_ADAPTER = "/home/huangtenghui/LLMAudit/SLoRA"
 
+# 预测参数默认值
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_MAX_LENGTH = 512
+
+# 微批处理：窗口内到达的 /api/predict 请求合并为一次前向
+PREDICT_MAX_BATCH = 16
+PREDICT_MAX_WAIT_MS = 10
+
+# 主题修改先记在内存中，最多每隔该时间（秒）批量写入一次数据库
+THEME_FLUSH_INTERVAL = 0.5
+
+# /api/status_stream 推送间隔（秒）
+STATUS_STREAM_INTERVAL = 0.2
+# 单条 SSE 连接的最长时长（秒）。uvicorn 优雅退出时会等待未结束的响应，
+# 限制时长保证退出不依赖客户端断开；浏览器 EventSource 会按 retry 自动重连
+STATUS_STREAM_MAX_SECONDS = 10
+
 # ==========================
 # 模型服务单例
 # ==========================
 model_server = ContractClassifierServer(DEFAULT_BASE, DEFAULT_ADAPTER)
+predict_batcher = PredictBatcher(model_server, PREDICT_MAX_BATCH, PREDICT_MAX_WAIT_MS)
 
 # ==========================
 # lifespan 生命周期事件
 # ==========================
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    loop = asyncio.get_event_loop()
+def run_in_daemon_thread(fn, *args):
+    """
+    在守护线程中执行阻塞函数并返回 Future。
+    线程池的线程在解释器退出时会被等待，守护线程不会，进程可以在函数返回前退出。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            callback = (resolve, future.set_exception, e)
+        else:
+            callback = (resolve, future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(*callback)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    threading.Thread(target=target, name="model-load", daemon=True).start()
+    return future
+
+async def load_initial_model(app: FastAPI):
     print("[🚀] 正在加载模型，请稍候...")
-    success, msg = await loop.run_in_executor(None, model_server.load_model)
+    # 冷启动加载放在守护线程：加载期间收到退出信号时不必等待加载完成；
+    # 这段时间 predict 直接返回 503，/api/reload 通过 model_server.lock 与其串行
+    success, msg = await run_in_daemon_thread(model_server.load_model)
     if not success:
         app.state.model_load_error = msg
         print(f"[⚠️] 模型加载失败: {msg}")
     else:
         print("[✅] 模型已成功加载")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 推理专用单线程池：前向天然串行，不与默认线程池里的其他任务争抢 CUDA 上下文
+    app.state.inference_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer")
+    predict_batcher.start(app.state.inference_pool)
+    # 模型在后台加载，服务先启动，前端可通过 /api/status_stream 查看加载进度
+    app.state.load_task = asyncio.create_task(load_initial_model(app))
+    app.state.theme_flush_event = asyncio.Event()
+    app.state.theme_flush_task = asyncio.create_task(flush_themes_loop(app))
+
     yield  # 应用运行中
 
+    app.state.theme_flush_task.cancel()
+    try:
+        await app.state.theme_flush_task
+    except asyncio.CancelledError:
+        pass
+    await flush_pending_themes()
+    load_finished = app.state.load_task.done()
+    if not load_finished:
+        print("[⚠️] 模型仍在加载，直接退出，不等待加载完成")
+        app.state.load_task.cancel()
+    await predict_batcher.stop()
+    app.state.inference_pool.shutdown(wait=load_finished, cancel_futures=True)
     try:
-        model_server.release()
-        print("[🧹] 模型资源已释放")
+        if model_server.release():
+            print("[🧹] 模型资源已释放")
     except Exception as e:
         print(f"[⚠️] 模型释放时出错: {e}")
 
 # ==========================
 # 创建应用
 # ==========================
-app = FastAPI(title="SCAudit Model API", lifespan=lifespan)
+app = FastAPI(title="SCAudit Model API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 # 开发阶段允许所有来源跨域
@@ -71,8 +145,9 @@ app.add_middleware(
 # ==========================
 class PredictRequest(BaseModel):
     text: str
-    threshold: Optional[float] = 0.5
-    max_length: Optional[int] = 512
+    # 前端输入非数字时 JSON 中为 null，按默认值处理
+    threshold: Optional[float] = Field(DEFAULT_THRESHOLD, ge=0.0, le=1.0)
+    max_length: Optional[int] = Field(DEFAULT_MAX_LENGTH, gt=0)
 
 class ReloadRequest(BaseModel):
     base_path: Optional[str] = None
@@ -82,22 +157,42 @@ class ReloadRequest(BaseModel):
 # API 路由
 # ==========================
 @app.get("/api/status")
-def status():
+async def status():
     """检查模型加载状态"""
     return model_server.status()
 
+@app.get("/api/status_stream")
+async def status_stream(request: Request):
+    """以 SSE 推送模型状态与加载进度，模型就绪或加载失败后结束"""
+    async def generate():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STATUS_STREAM_MAX_SECONDS
+        yield b"retry: 500\n\n"
+        while not await request.is_disconnected():
+            status = model_server.status()
+            yield b"data: " + orjson.dumps(status) + b"\n\n"
+            if status["ready"] or status["last_load_error"] or loop.time() >= deadline:
+                break
+            await asyncio.sleep(STATUS_STREAM_INTERVAL)
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
 @app.post("/api/predict")
 async def predict(req: PredictRequest):
     """智能合约漏洞检测"""
     if not req.text or not req.text.strip():
         raise HTTPException(status_code=400, detail="text is empty")
+    # 加载/重载期间直接返回 503，不在队列里等待
+    if not model_server.is_ready():
+        raise HTTPException(status_code=503, detail="model not ready: " + (model_server.last_load_error or "loading"))
 
-    loop = asyncio.get_event_loop()
     try:
-        matched, probs = await loop.run_in_executor(
-            None, model_server.predict, req.text, req.threshold, req.max_length
-        )
+        threshold = DEFAULT_THRESHOLD if req.threshold is None else req.threshold
+        max_length = DEFAULT_MAX_LENGTH if req.max_length is None else req.max_length
+        matched, probs = await predict_batcher.submit(req.text, threshold, max_length)
         return {"labels": matched, "probs": probs}
+    except ModelNotReadyError as e:
+        # 入队后才开始重载的请求
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -106,9 +201,10 @@ async def reload_model(req: ReloadRequest):
     """热重载模型"""
     new_base = req.base_path or model_server.base_model_path
     new_adapter = req.adapter_path or model_server.adapter_path
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    # 与推理共用同一线程：只切换 adapter 时会原地修改模型，不能和正在进行的前向并发
     success, msg = await loop.run_in_executor(
-        None, model_server.load_model, new_base, new_adapter
+        app.state.inference_pool, model_server.load_model, new_base, new_adapter
     )
     if not success:
         raise HTTPException(status_code=500, detail=f"reload failed: {msg}")
@@ -116,50 +212,162 @@ async def reload_model(req: ReloadRequest):
 
 
 from fastapi import Request
-from fastapi.responses import JSONResponse
-import json
 
-USER_DB = os.path.join(os.path.dirname(__file__), "users.json")
+USER_DB = os.path.join(os.path.dirname(__file__), "users.db")
+LEGACY_USER_JSON = os.path.join(os.path.dirname(__file__), "users.json")
 
-# 初始化用户数据库
-if not os.path.exists(USER_DB):
-    with open(USER_DB, "w", encoding="utf-8") as f:
-        json.dump({"admin": {"password": "123456", "theme": "light"}}, f, ensure_ascii=False, indent=2)
+# bcrypt 代价因子：每次哈希/校验约 50ms，可按 CPU 预算调整
+BCRYPT_ROUNDS = 10
 
-def load_users():
-    with open(USER_DB, "r", encoding="utf-8") as f:
-        return json.load(f)
+def _password_bytes(password):
+    # bcrypt 只使用前 72 字节，新版 bcrypt 对更长输入直接报错，这里显式截断
+    return password.encode("utf-8")[:72]
 
-def save_users(users):
-    with open(USER_DB, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+def hash_password(password):
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("ascii")
+
+# 完整的 bcrypt 哈希：$2a$/$2b$/$2x$/$2y$ + 两位代价因子 + 53 位 salt 与摘要，共 60 个字符
+BCRYPT_HASH_RE = re.compile(r"\$2[abxy]\$\d\d\$[./A-Za-z0-9]{53}")
+
+def is_password_hash(value):
+    return BCRYPT_HASH_RE.fullmatch(value) is not None
+
+def verify_password(password, hashed):
+    """常数时间比较，由 bcrypt 完成；存储值不是合法哈希时视为校验失败"""
+    try:
+        return bcrypt.checkpw(_password_bytes(password), hashed.encode("utf-8"))
+    except ValueError:
+        return False
+
+# 用户不存在时也做一次校验，避免通过响应时间探测用户名
+DUMMY_PASSWORD_HASH = hash_password("")
+
+# 初始化用户数据库（SQLite + WAL，按 username 主键点查）
+def init_user_db():
+    conn = sqlite3.connect(USER_DB, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # 读路径走 mmap，登录点查直接命中内存页；其他进程写入后 SQLite 按文件变更计数自动失效缓存
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS users("
+        "username TEXT PRIMARY KEY, password TEXT NOT NULL, theme TEXT NOT NULL DEFAULT 'light')"
+    )
+
+    # 首次启动：从旧版 users.json 迁移，没有则写入默认管理员
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+        if os.path.exists(LEGACY_USER_JSON):
+            with open(LEGACY_USER_JSON, "rb") as f:
+                users = orjson.loads(f.read())
+        else:
+            users = {"admin": {"password": "123456", "theme": "light"}}
+        conn.executemany(
+            "INSERT OR IGNORE INTO users(username, password, theme) VALUES (?, ?, ?)",
+            [(name, u["password"], u.get("theme", "light")) for name, u in users.items()],
+        )
+
+    # 旧数据中的明文密码就地升级为 bcrypt 哈希（按旧值条件更新，多 worker 同时启动也只生效一次）
+    for username, password in conn.execute("SELECT username, password FROM users").fetchall():
+        if is_password_hash(password):
+            continue
+        conn.execute(
+            "UPDATE users SET password = ? WHERE username = ? AND password = ?",
+            (hash_password(password), username, password),
+        )
+    return conn
+
+user_db = init_user_db()
+# 多个线程共用同一连接，进程内写操作串行执行；跨进程由 SQLite 文件锁保证原子性
+user_db_write_lock = threading.Lock()
+
+# 以下均为阻塞调用，在接口中通过 asyncio.to_thread 执行
+def get_user(username):
+    """返回 (password_hash, theme)，用户不存在时返回 None"""
+    return user_db.execute(
+        "SELECT password, theme FROM users WHERE username = ?", (username,)
+    ).fetchone()
+
+def create_user(username, password, theme="light"):
+    """创建用户，用户名已存在时返回 False"""
+    try:
+        with user_db_write_lock:
+            user_db.execute(
+                "INSERT INTO users(username, password, theme) VALUES (?, ?, ?)",
+                (username, password, theme),
+            )
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+def set_user_themes(updates):
+    """在一个事务里批量写入 [(username, theme), ...]"""
+    with user_db_write_lock:
+        user_db.execute("BEGIN")
+        try:
+            user_db.executemany(
+                "UPDATE users SET theme = ? WHERE username = ?",
+                [(theme, username) for username, theme in updates],
+            )
+            user_db.execute("COMMIT")
+        except Exception:
+            user_db.execute("ROLLBACK")
+            raise
+
+# 尚未落盘的主题修改：username -> theme（仅在事件循环线程中读写）
+pending_themes = {}
+
+async def flush_pending_themes():
+    if not pending_themes:
+        return
+    updates = list(pending_themes.items())
+    pending_themes.clear()
+    try:
+        await asyncio.to_thread(set_user_themes, updates)
+    except Exception as e:
+        # 写入失败时放回队列（期间的新修改优先），等待下次刷新
+        for username, theme in updates:
+            pending_themes.setdefault(username, theme)
+        print(f"[⚠️] 主题写入失败: {e}")
+
+async def flush_themes_loop(app: FastAPI):
+    """后台任务：有修改时等待 THEME_FLUSH_INTERVAL 收集更多修改，再一次性写入"""
+    while True:
+        await app.state.theme_flush_event.wait()
+        await asyncio.sleep(THEME_FLUSH_INTERVAL)
+        app.state.theme_flush_event.clear()
+        await flush_pending_themes()
+        if pending_themes:
+            app.state.theme_flush_event.set()
+
+def set_user_password(username, password, old_password):
+    """仅当当前密码仍为 old_password 时更新，避免并发修改互相覆盖"""
+    with user_db_write_lock:
+        return user_db.execute(
+            "UPDATE users SET password = ? WHERE username = ? AND password = ?",
+            (password, username, old_password),
+        ).rowcount > 0
 
 
 @app.post("/api/register")
 async def register_user(req: Request):
     """创建新账户"""
-    data = await req.json()
+    data = orjson.loads(await req.body())
     username = data.get("username")
     password = data.get("password")
 
     # 参数检查
     if not username or not password:
-        return JSONResponse(status_code=400, content={"error": "用户名和密码不能为空"})
-
-    users = load_users()
+        return ORJSONResponse(status_code=400, content={"error": "用户名和密码不能为空"})
 
-    # 检查是否已存在
-    if username in users:
-        return JSONResponse(status_code=400, content={"error": "用户名已存在"})
-
-    # 写入新账户
-    users[username] = {"password": password, "theme": "light"}
-    save_users(users)
+    # 写入新账户（主键冲突即已存在）
+    password_hash = await asyncio.to_thread(hash_password, password)
+    if not await asyncio.to_thread(create_user, username, password_hash):
+        return ORJSONResponse(status_code=400, content={"error": "用户名已存在"})
     print(f"[🆕] 新用户注册成功: {username}")
 
     # 注册成功后直接返回登录凭证
     token = f"token-{username}"
-    response = JSONResponse(content={
+    response = ORJSONResponse(content={
         "message": "注册成功",
         "username": username,
         "theme": "light",
@@ -172,18 +380,22 @@ async def register_user(req: Request):
 
 @app.post("/api/login")
 async def login(req: Request):
-    data = await req.json()
+    data = orjson.loads(await req.body())
     username = data.get("username")
     password = data.get("password")
 
-    users = load_users()
-    user = users.get(username)
-    if not user or user["password"] != password:
-        return JSONResponse(status_code=401, content={"error": "用户名或密码错误"})
+    if not username or not password:
+        return ORJSONResponse(status_code=401, content={"error": "用户名或密码错误"})
+
+    user = await asyncio.to_thread(get_user, username)
+    password_ok = await asyncio.to_thread(verify_password, password, user[0] if user else DUMMY_PASSWORD_HASH)
+    if not user or not password_ok:
+        return ORJSONResponse(status_code=401, content={"error": "用户名或密码错误"})
 
     # ✅ 增加 token
     token = f"token-{username}"
-    response = JSONResponse(content={"username": username, "theme": user.get("theme", "light"), "token": token})
+    theme = pending_themes.get(username, user[1])
+    response = ORJSONResponse(content={"username": username, "theme": theme, "token": token})
     response.set_cookie(key="username", value=username, httponly=False, max_age=3600, path="/")
     return response
 
@@ -191,40 +403,42 @@ async def login(req: Request):
 
 @app.post("/api/theme")
 async def update_theme(req: Request):
-    data = await req.json()
+    data = orjson.loads(await req.body())
     username = data.get("username")
     theme = data.get("theme")
     token = data.get("token")
 
     if not username or not theme:
-        return JSONResponse(status_code=400, content={"error": "参数缺失"})
+        return ORJSONResponse(status_code=400, content={"error": "参数缺失"})
 
     # ✅ 简化 token 校验逻辑，允许 token 不传也能保存（便于前端调试）
     if token and token != f"token-{username}":
-        return JSONResponse(status_code=401, content={"error": "无效的用户身份"})
+        return ORJSONResponse(status_code=401, content={"error": "无效的用户身份"})
 
-    users = load_users()
-    if username not in users:
-        return JSONResponse(status_code=404, content={"error": "用户不存在"})
+    if await asyncio.to_thread(get_user, username) is None:
+        return ORJSONResponse(status_code=404, content={"error": "用户不存在"})
 
-    users[username]["theme"] = theme
-    save_users(users)
+    # 只更新内存，由后台任务批量落盘
+    pending_themes[username] = theme
+    req.app.state.theme_flush_event.set()
     print(f"[🎨] 用户 {username} 已更新主题为: {theme}")
 
-    return {"message": "主题已更新", "theme": theme}
+    # 前端不读取响应体
+    return Response(status_code=204)
 
 
 
 
 @app.post("/api/logout")
 async def logout_user(req: Request):
-    data = await req.json()
+    data = orjson.loads(await req.body())
     username = data.get("username")
     token = data.get("token")
 
     if not username:
-        return JSONResponse(status_code=400, content={"error": "缺少用户名"})
-    response = JSONResponse(content={"message": "退出成功"})
+        return ORJSONResponse(status_code=400, content={"error": "缺少用户名"})
+    # 前端不读取响应体，204 仍会带上删除 cookie 的响应头
+    response = Response(status_code=204)
     response.delete_cookie("username")
     print(f"[🚪] 用户 {username} 已退出登录")
     return response
@@ -234,7 +448,7 @@ async def logout_user(req: Request):
 @app.post("/api/change_password")
 async def change_password(req: Request):
     """用户修改密码"""
-    data = await req.json()
+    data = orjson.loads(await req.body())
     username = data.get("username")
     old_pwd = data.get("old_password")
     new_pwd = data.get("new_password")
@@ -242,22 +456,22 @@ async def change_password(req: Request):
 
     # 参数检查
     if not username or not old_pwd or not new_pwd:
-        return JSONResponse(status_code=400, content={"error": "缺少必要参数"})
+        return ORJSONResponse(status_code=400, content={"error": "缺少必要参数"})
 
     # ✅ 校验 token（如果前端传入）
     if token and token != f"token-{username}":
-        return JSONResponse(status_code=401, content={"error": "无效的用户身份"})
+        return ORJSONResponse(status_code=401, content={"error": "无效的用户身份"})
 
-    users = load_users()
-    user = users.get(username)
+    user = await asyncio.to_thread(get_user, username)
     if not user:
-        return JSONResponse(status_code=404, content={"error": "用户不存在"})
+        return ORJSONResponse(status_code=404, content={"error": "用户不存在"})
 
-    if user["password"] != old_pwd:
-        return JSONResponse(status_code=403, content={"error": "旧密码错误"})
+    if not await asyncio.to_thread(verify_password, old_pwd, user[0]):
+        return ORJSONResponse(status_code=403, content={"error": "旧密码错误"})
 
-    users[username]["password"] = new_pwd
-    save_users(users)
+    new_hash = await asyncio.to_thread(hash_password, new_pwd)
+    if not await asyncio.to_thread(set_user_password, username, new_hash, user[0]):
+        return ORJSONResponse(status_code=403, content={"error": "旧密码错误"})
     print(f"[🔑] 用户 {username} 修改了密码")
 
     return {"message": "密码修改成功，请重新登录"}
@@ -275,13 +489,54 @@ async def get_userinfo(request: Request):
 # ========================== 
 # # 前端网页挂载（终极修正版） 
 # # ========================== 
-from fastapi.responses import FileResponse
+from starlette.datastructures import Headers
+import hashlib
+
+class CachedStaticFiles(StaticFiles):
+    """
+    小文件常驻内存的 StaticFiles：首次访问时读入内容并计算 ETag，之后直接从内存返回，
+    If-None-Match 命中时返回 304。超过 MAX_CACHED_SIZE 的文件仍按原方式从磁盘流式返回。
+    注意：前端文件修改后需重启服务才会生效。
+    """
+    MAX_CACHED_SIZE = 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cache = {}  # path -> (content, etag, media_type)
+
+    @staticmethod
+    def _read_with_etag(file_path):
+        with open(file_path, "rb") as f:
+            content = f.read()
+        return content, f'"{hashlib.sha1(content).hexdigest()}"'
+
+    async def get_response(self, path, scope):
+        # 非 GET/HEAD 交给父类返回 405，不能被缓存命中绕过
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        cached = self._cache.get(path)
+        if cached is None:
+            response = await super().get_response(path, scope)
+            if not isinstance(response, FileResponse) or response.status_code != 200:
+                return response
+            if response.stat_result is None or response.stat_result.st_size > self.MAX_CACHED_SIZE:
+                return response
+            # 与父类一致，文件读取放到线程中，不阻塞事件循环
+            content, etag = await asyncio.to_thread(self._read_with_etag, response.path)
+            cached = (content, etag, response.media_type)
+            self._cache[path] = cached
+
+        content, etag, media_type = cached
+        if Headers(scope=scope).get("if-none-match") == etag:
+            return Response(status_code=304, headers={"etag": etag})
+        return Response(content, media_type=media_type, headers={"etag": etag})
 
 frontend_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../frontend"))
 
 if os.path.exists(frontend_dir):
     # ✅ 让所有前端文件（HTML、CSS、JS）都可直接访问
-    app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="frontend")
+    app.mount("/", CachedStaticFiles(directory=frontend_dir, html=True), name="frontend")
 
     # ✅ 默认访问 / 时显示登录页
     @app.get("/")
@@ -6,12 +6,21 @@ Model server wrapper.
 """
 import os
 import sys
+import asyncio
+import hashlib
 import threading
-from typing import List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
-from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, PreTrainedTokenizerFast
 from peft import PeftModel
+from peft.utils import ModulesToSaveWrapper
+
+# HF tokenizers 的 Rayon 线程池会和推理线程、uvicorn worker 抢核
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 # labels 直接从你提供的代码复用（可按需修改）
 LABELS = [
@@ -23,6 +32,17 @@ LABELS = [
     'Locked Ether: Ether sent to a contract cannot be withdrawn because there is no withdrawal function or self-destruct.',
     'Time Manipulation (Block values as a proxy for time): Directly relying on block.timestamp or block.number as time sources, which miners can slightly alter.'
 ]
+LABELS_ARR = np.asarray(LABELS, dtype=object)
+
+# 序列长度按 64 分桶补齐：避免短文本也按 max_length 计算，同时让编译/CUDA graph 只遇到少数几种形状
+PAD_MULTIPLE = 64
+
+# 单条文本 tokenize 结果的 LRU 缓存容量（同一合约反复提交、只调阈值时跳过 tokenize）
+ENCODE_CACHE_SIZE = 1024
+
+class ModelNotReadyError(RuntimeError):
+    """模型尚未加载完成或正在重载，调用方应返回 503。"""
+
 
 class ContractClassifierServer:
     """
@@ -32,43 +52,144 @@ class ContractClassifierServer:
         self.base_model_path = base_model_path
         self.adapter_path = adapter_path
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        # lock 只保护 load_model/release 这类修改操作，推理路径不加锁
         self.lock = threading.RLock()
+        # 模型可用时置位；加载/重载期间清除，predict 据此快速失败而不是排队等待
+        self._ready = threading.Event()
         self.model = None
         self.tokenizer = None
+        self.pad_token_id = None
+        # (文本摘要, max_length) -> input_ids；只依赖 tokenizer，切换 adapter 时保留
+        self._encode_cache = OrderedDict()
+        # 未经 torch.compile 包装的模型与其底座，用于只切换 adapter 时复用底座权重
+        self._raw_model = None
+        self._base_model = None
+        self._loaded_base_path = None
         self.loaded = False
         self.last_load_error = None
+        # 加载进度（对应 load_model 中的 1️⃣–7️⃣ 步），供 /api/status_stream 推送
+        self.load_progress = {"step": 0, "total": 7, "stage": "未加载"}
         # 延迟加载不在 __init__ 里直接触发，调用 load_model 启动加载
     def _local_files_only(self):
         # 在有些部署会希望从远程加载，现阶段强制本地加载
         return True
 
+    def _configure_threads(self):
+        """
+        限制 PyTorch intra/inter-op 线程数，避免多核机器上线程超额订阅。
+        GPU 部署默认 1（并行度来自批处理和 uvicorn worker）；纯 CPU 部署可通过 TORCH_NUM_THREADS 指定。
+        """
+        num_threads = os.environ.get("TORCH_NUM_THREADS")
+        if num_threads:
+            num_threads = int(num_threads)
+        elif self.device == "cuda":
+            num_threads = 1
+        else:
+            return
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(num_threads)
+        except RuntimeError:
+            # inter-op 线程数只能在首次并行计算前设置一次，热重载时忽略
+            pass
+
+    def _torch_dtype(self):
+        """CUDA 上用 BF16（不支持时退回 FP16），CPU 保持 FP32。"""
+        if self.device != "cuda":
+            return torch.float32
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+    def _compile(self, model, tokenizer):
+        """
+        torch.compile 并预热，让真实请求不承担编译开销。
+        批大小和序列长度都会变化，因此按动态形状编译且不用 CUDA graph（graph 每种形状都要重新捕获）。
+        dynamo 会对大小为 1 的维度单独特化，所以分别用 batch=1 和 batch=2 预热，覆盖这两份编译图。
+        默认仅在 CUDA 上启用，可通过 TORCH_COMPILE=0/1 覆盖；编译失败时回退到 eager 模型。
+        """
+        enabled = os.environ.get("TORCH_COMPILE", "1" if self.device == "cuda" else "0") == "1"
+        if not enabled:
+            return model
+        try:
+            compiled = torch.compile(model, dynamic=True, fullgraph=False)
+            for batch_size in (1, 2):
+                inputs = tokenizer(
+                    ["warmup"] * batch_size, return_tensors="pt", padding="longest", pad_to_multiple_of=PAD_MULTIPLE
+                )
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                with torch.inference_mode():
+                    compiled(**inputs)
+            print("[✅] torch.compile 预热完成。")
+            return compiled
+        except Exception as e:
+            print(f"[⚠️] torch.compile 失败，使用 eager 模式：{e}")
+            return model
+
+    def _unload_adapter(self, peft_model, base_model):
+        """
+        卸下 LoRA 层，并把 modules_to_save 包装的模块（如 score 分类头）换回底座的原始模块。
+        peft 的 unload() 会用 adapter 训练过的副本替换这些模块，不处理的话旧 adapter 的分类头会残留在复用的底座上。
+        """
+        originals = [
+            (name, module.original_module)
+            for name, module in base_model.named_modules()
+            if isinstance(module, ModulesToSaveWrapper)
+        ]
+        peft_model.unload()
+        for name, original in originals:
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(base_model.get_submodule(parent_name), child_name, original)
+
+    def _set_progress(self, step: int, stage: str):
+        self.load_progress = {"step": step, "total": 7, "stage": stage}
+
     def load_model(self, base_model_path: Optional[str] = None, adapter_path: Optional[str] = None):
         with self.lock:
             base_path = base_model_path or self.base_model_path
             adapter = adapter_path or self.adapter_path
+            self._ready.clear()
+            self.last_load_error = None
 
             print(f"\n[🧠] 正在加载模型：")
             print(f"     ➤ Base model: {base_path}")
             print(f"     ➤ Adapter: {adapter or '(无)'}")
             print(f"     ➤ Device: {self.device}")
 
+            # base 未变时只切换 adapter，不重新实例化 1B 参数
+            reuse_base = self._base_model is not None and base_path == self._loaded_base_path
+
             try:
-                # --- 1️⃣ 加载配置 ---
-                config = AutoConfig.from_pretrained(
-                    base_path,
-                    num_labels=len(LABELS),
-                    problem_type="multi_label_classification",
-                    local_files_only=self._local_files_only()
-                )
+                if reuse_base:
+                    # --- 1️⃣ 2️⃣ 复用已加载的基础模型，卸下旧 adapter ---
+                    self._set_progress(2, "复用基础模型")
+                    print("[ℹ️] Base model 未变化，复用已加载权重，仅切换 adapter。")
+                    base_model = self._base_model
+                    if isinstance(self._raw_model, PeftModel):
+                        self._unload_adapter(self._raw_model, base_model)
+                    self._raw_model = base_model
+                else:
+                    # --- 1️⃣ 加载配置 ---
+                    self._set_progress(1, "加载配置")
+                    config = AutoConfig.from_pretrained(
+                        base_path,
+                        num_labels=len(LABELS),
+                        problem_type="multi_label_classification",
+                        local_files_only=self._local_files_only()
+                    )
 
-                # --- 2️⃣ 加载基础模型（不忽略维度不匹配）---
-                base_model = AutoModelForSequenceClassification.from_pretrained(
-                    base_path,
-                    config=config,
-                    local_files_only=self._local_files_only()
-                )
+                    # --- 2️⃣ 加载基础模型（不忽略维度不匹配）---
+                    # 按目标精度直接把 safetensors 加载到目标设备，跳过 FP32 的 CPU 中转副本
+                    self._set_progress(2, "加载基础模型")
+                    base_model = AutoModelForSequenceClassification.from_pretrained(
+                        base_path,
+                        config=config,
+                        local_files_only=self._local_files_only(),
+                        torch_dtype=self._torch_dtype(),
+                        low_cpu_mem_usage=True,
+                        device_map={"": self.device}
+                    )
 
                 # --- 3️⃣ 加载 adapter（如果存在）---
+                self._set_progress(3, "加载 adapter")
                 if adapter and os.path.isdir(adapter):
                     try:
                         model = PeftModel.from_pretrained(
@@ -86,29 +207,59 @@ class ContractClassifierServer:
                     model = base_model
 
                 # --- 4️⃣ 设置设备 ---
-                model.to(self.device)
+                self._set_progress(4, "设置设备")
+                # 基础模型已在目标设备和精度上；这里只把新加载的 adapter 权重统一过去
+                # （分类前向受矩阵乘带宽限制，半精度减半权重读取量）
+                model.to(self.device, self._torch_dtype())
                 model.eval()
+                self._configure_threads()
 
                 # --- 5️⃣ 加载 tokenizer ---
-                tokenizer = AutoTokenizer.from_pretrained(base_path, local_files_only=self._local_files_only())
-                if tokenizer.pad_token is None:
-                    tokenizer.pad_token = tokenizer.eos_token
+                self._set_progress(5, "加载 tokenizer 并预热")
+                if reuse_base:
+                    tokenizer = self.tokenizer
+                else:
+                    tokenizer = AutoTokenizer.from_pretrained(base_path, use_fast=True, local_files_only=self._local_files_only())
+                    if not isinstance(tokenizer, PreTrainedTokenizerFast):
+                        raise RuntimeError(f"需要 fast tokenizer（tokenizer.json），实际加载到 {type(tokenizer).__name__}")
+                    if tokenizer.pad_token is None:
+                        tokenizer.pad_token = tokenizer.eos_token
+                    # 批量推理需要右侧 padding，且模型要知道 pad_token_id 才能定位最后一个有效 token
+                    tokenizer.padding_side = "right"
+                model.config.pad_token_id = tokenizer.pad_token_id
+                raw_model = model
+                if reuse_base:
+                    # 只切换 adapter 时不重新编译：编译加预热的耗时超过省下的底座加载时间，
+                    # 新 adapter 先以 eager 模式运行，下次完整加载时再编译
+                    print("[ℹ️] 仅切换 adapter，跳过 torch.compile（eager 模式运行）。")
+                else:
+                    model = self._compile(model, tokenizer)
 
-                # --- 6️⃣ 清理旧模型 ---
-                try:
-                    if getattr(self, "model", None) is not None:
-                        del self.model
-                        torch.cuda.empty_cache()
-                except Exception:
-                    pass
+                # --- 6️⃣ 清理旧模型（仅在 base 变化时才需要归还显存）---
+                self._set_progress(6, "清理旧模型")
+                if not reuse_base:
+                    try:
+                        if getattr(self, "model", None) is not None:
+                            self.model = self._raw_model = self._base_model = None
+                            torch.cuda.empty_cache()
+                    except Exception:
+                        pass
 
                 # --- 7️⃣ 保存新模型 ---
                 self.model = model
+                self._raw_model = raw_model
+                self._base_model = base_model
+                self._loaded_base_path = base_path
+                if not reuse_base:
+                    self._encode_cache.clear()
                 self.tokenizer = tokenizer
+                self.pad_token_id = tokenizer.pad_token_id
                 self.base_model_path = base_path
                 self.adapter_path = adapter
                 self.loaded = True
                 self.last_load_error = None
+                self._set_progress(7, "加载完成")
+                self._ready.set()
 
                 print("[✅] 模型加载完成！")
                 return True, "loaded"
@@ -116,41 +267,202 @@ class ContractClassifierServer:
             except Exception as e:
                 self.loaded = False
                 self.last_load_error = str(e)
+                self._set_progress(0, "加载失败")
                 print(f"[❌] 模型加载失败：{e}")
+                # 归还加载到一半的权重占用的显存
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
                 return False, str(e)
 
             
 
+    def is_ready(self) -> bool:
+        """模型已加载且当前没有在重载"""
+        return self._ready.is_set()
+
     def predict(self, text: str, threshold: float = 0.5, max_length: int = 512) -> Tuple[List[str], List[float]]:
         """
         返回 (matched_labels, probs)
         """
-        if not self.loaded:
-            raise RuntimeError("Model not loaded: " + (self.last_load_error or "unknown"))
-        with self.lock:
-            # tokenize
-            inputs = self.tokenizer(
-                text,
-                return_tensors="pt",
-                truncation=True,
-                padding=True,
-                max_length=max_length
-            )
-            # move inputs to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits = outputs.logits
-                probs = torch.sigmoid(logits).cpu().numpy()[0].tolist()
-            matched = [LABELS[i] for i, p in enumerate(probs) if p >= threshold]
-            return matched, probs
+        return self.predict_batch([text], threshold, max_length)[0]
+
+    def predict_batch(self, texts: List[str], threshold: Union[float, Sequence[float]] = 0.5, max_length: int = 512) -> List[Tuple[List[str], List[float]]]:
+        """
+        一次前向处理多条文本，按输入顺序返回 [(matched_labels, probs), ...]。
+        threshold 可以是统一的阈值，也可以是与 texts 等长的逐条阈值。
+        推理不加锁：先取出 model/tokenizer 的引用，热重载替换时不影响正在进行的批次。
+        """
+        if not self._ready.is_set():
+            raise ModelNotReadyError("model not ready: " + (self.last_load_error or "loading"))
+        model, tokenizer, pad_token_id = self.model, self.tokenizer, self.pad_token_id
+        inputs = self._encode(tokenizer, pad_token_id, list(texts), max_length)
+
+        # sigmoid 与阈值判断在设备上完成，之后各做一次 D2H 拷贝
+        with torch.inference_mode():
+            outputs = model(**inputs)
+            probs = torch.sigmoid(outputs.logits.float())
+            thresholds = torch.as_tensor(threshold, dtype=probs.dtype, device=probs.device)
+            if thresholds.ndim == 1:
+                thresholds = thresholds[:, None]
+            mask = probs >= thresholds
+            probs_cpu, mask_cpu = probs.cpu().numpy(), mask.cpu().numpy()
+        return [
+            (LABELS_ARR[mask_cpu[i]].tolist(), probs_cpu[i].tolist())
+            for i in range(len(texts))
+        ]
+
+    def _encode(self, tokenizer, pad_token_id: int, texts: List[str], max_length: int) -> dict:
+        """
+        tokenize 并补齐到批内最长长度向上取整到 PAD_MULTIPLE，返回已拷贝到设备上的 inputs。
+        未命中缓存的文本整批 tokenize 一次；CUDA 上先在 pinned memory 中组装，再异步拷贝到显存。
+        """
+        cache = self._encode_cache
+        keys = [(hashlib.blake2b(t.encode("utf-8"), digest_size=16).digest(), max_length) for t in texts]
+        misses = [i for i, key in enumerate(keys) if key not in cache]
+        if misses:
+            encoded = tokenizer([texts[i] for i in misses], truncation=True, max_length=max_length)["input_ids"]
+            for i, ids in zip(misses, encoded):
+                cache[keys[i]] = torch.tensor(ids, dtype=torch.long)
+
+        ids_list = []
+        for key in keys:
+            cache.move_to_end(key)
+            ids_list.append(cache[key])
+        while len(cache) > ENCODE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        longest = max(len(ids) for ids in ids_list)
+        seq_len = -(-longest // PAD_MULTIPLE) * PAD_MULTIPLE
+        pin = self.device == "cuda"
+        input_ids = torch.full((len(ids_list), seq_len), pad_token_id, dtype=torch.long, pin_memory=pin)
+        attention_mask = torch.zeros((len(ids_list), seq_len), dtype=torch.long, pin_memory=pin)
+        for i, ids in enumerate(ids_list):
+            input_ids[i, :len(ids)] = ids
+            attention_mask[i, :len(ids)] = 1
+        return {
+            "input_ids": input_ids.to(self.device, non_blocking=True),
+            "attention_mask": attention_mask.to(self.device, non_blocking=True),
+        }
+
+    def release(self) -> bool:
+        """
+        释放模型与显存，返回是否已释放。
+        若 load_model 仍在进行（持有 lock），不等待加载完成，直接返回 False。
+        """
+        if not self.lock.acquire(blocking=False):
+            self._ready.clear()
+            return False
+        try:
+            self._ready.clear()
+            self.model = None
+            self.tokenizer = None
+            self.pad_token_id = None
+            self._encode_cache.clear()
+            self._raw_model = None
+            self._base_model = None
+            self._loaded_base_path = None
+            self.loaded = False
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        finally:
+            self.lock.release()
+        return True
 
     def status(self):
         return {
             "loaded": self.loaded,
+            # 重载期间 loaded 仍为 True（旧模型仍在内存中），但 predict 会返回 503
+            "ready": self._ready.is_set(),
             "device": self.device,
             "base_model_path": self.base_model_path,
             "adapter_path": self.adapter_path,
-            "last_load_error": self.last_load_error
+            "last_load_error": self.last_load_error,
+            "load_progress": self.load_progress
         }
+
+
+class PredictBatcher:
+    """
+    微批处理：把 max_wait_ms 时间窗口内到达的并发请求合并成一次 predict_batch 前向。
+    submit() 在事件循环中调用，结果通过每个请求自己的 Future 返回。
+    """
+    def __init__(self, server: ContractClassifierServer, max_batch_size: int = 16, max_wait_ms: float = 10):
+        self.server = server
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[Executor] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, executor: Optional[Executor] = None):
+        """executor 为执行 predict_batch 的线程池，None 表示事件循环默认线程池。"""
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # 让仍在排队的请求立即失败，而不是永远挂起
+        while not self.queue.empty():
+            *_, fut = self.queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("predict batcher stopped"))
+
+    async def submit(self, text: str, threshold: float = 0.5, max_length: int = 512) -> Tuple[List[str], List[float]]:
+        if self._task is None:
+            raise RuntimeError("predict batcher not started")
+        # 在入队前校验参数：非法值只让当前调用失败，不会连累同批的其他请求
+        threshold, max_length = float(threshold), int(max_length)
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, threshold, max_length, fut))
+        return await fut
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+
+            # max_length 决定截断长度，不同的请求不能共用一次 tokenize，按它分组；
+            # threshold 只作用于前向之后的比较，逐条传入即可
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+
+            for max_length, items in groups.items():
+                items = [it for it in items if not it[3].done()]  # 跳过已断开的请求
+                if not items:
+                    continue
+                try:
+                    results = await loop.run_in_executor(
+                        self.executor, self.server.predict_batch,
+                        [it[0] for it in items], [it[1] for it in items], max_length
+                    )
+                except Exception as e:
+                    for it in items:
+                        if not it[3].done():
+                            it[3].set_exception(e)
+                    continue
+                for it, result in zip(items, results):
+                    if not it[3].done():
+                        it[3].set_result(result)
@@ -32,6 +32,31 @@ function setProgress(text) {
   progressDiv.textContent = text;
 }
 
+// ========== 模型加载进度（SSE） ==========
+// untilReady=true：模型就绪或加载失败后自动关闭；
+// untilReady=false：由调用方关闭（重载时使用，重载请求可能晚于首条状态到达服务端）。
+// 服务端每条连接限时，断开后 EventSource 会自动重连，因此不在 onerror 中关闭
+function watchModelStatus(untilReady = true) {
+  const source = new EventSource(`${API_BASE}/api/status_stream`);
+  source.onmessage = (event) => {
+    const status = JSON.parse(event.data);
+    const { step, total, stage } = status.load_progress || {};
+    if (status.ready) {
+      if (untilReady) {
+        setProgress("模型已就绪 ✅");
+        source.close();
+      }
+    } else if (status.last_load_error) {
+      setProgress("模型加载失败: " + status.last_load_error);
+      if (untilReady) source.close();
+    } else {
+      setProgress(`模型加载中 (${step}/${total}) ${stage}...`);
+    }
+  };
+  return source;
+}
+watchModelStatus();
+
 async function predict() {
   const text = inputText.value.trim();
   if (!text) return alert("请输入智能合约源码！");
@@ -108,6 +133,7 @@ reloadBtn.addEventListener("click", async () => {
   if (adapter) payload.adapter_path = adapter;
   if (base) payload.base_path = base;
   setProgress("重新加载中...");
+  const statusSource = watchModelStatus(false);
   try {
     const resp = await fetch(`${API_BASE}/api/reload`, {
       method: "POST",
@@ -119,6 +145,8 @@ reloadBtn.addEventListener("click", async () => {
     setProgress("模型已切换");
   } catch (err) {
     setProgress("切换失败: " + err.message);
+  } finally {
+    statusSource.close();
   }
 });
 
@@ -17,5 +17,8 @@ if [ ! -f "$VENV_PYTHON" ]; then
   exit 1
 fi
 
-echo "✅ 使用虚拟环境 Python 启动服务..."
-"$VENV_PYTHON" -m uvicorn main:app --host 0.0.0.0 --port 8000 --workers 1
+# worker 数量：每个 worker 独立加载模型，GPU 部署注意显存上限
+WORKERS="${WEB_CONCURRENCY:-1}"
+
+echo "✅ 使用虚拟环境 Python 启动服务（workers=$WORKERS）..."
+"$VENV_PYTHON" -m uvicorn main:app --host 0.0.0.0 --port 8000 --workers "$WORKERS"